@@ -5,40 +5,81 @@ from __future__ import print_function, unicode_literals
 import os
 import sys
 import re
+import threading
 
 import click
 
 if __package__ is None:
     from __init__ import __version__
-    from utils import command, CommandError, chdir, git, ProgError
+    from utils import command, command_streaming, CommandError, git, git_version, ProgError, parallel_map
 else:
     from . import __version__
-    from .utils import (command, CommandError, chdir, git, ProgError, decode_utf8,
-                        current_branch)
+    from .utils import (command, command_streaming, CommandError, git, git_version, ProgError, decode_utf8,
+                        current_branch, parallel_map)
 
 click.disable_unicode_literals_warning = True
 
+RE_FROM_GIT_SVN_ID = re.compile(r"git-svn-id:.*@(\d+)")
+RE_FROM_SVNVERSION = re.compile(r"(\d+):(\d+)")
+
+# Serializes output when externals are processed by several threads; hold it
+# to print a multi-line report without other threads' lines in between
+output_lock = threading.RLock()
+
+
+def _join(args):
+    # most messages are a single, already formatted string
+    return args[0] if len(args) == 1 else u' '.join(args)
+
 
 def echo(*args):
-    click.echo(u' '.join(args))
+    with output_lock:
+        click.echo(_join(args))
 
 
 def info(*args):
-    click.secho(u' '.join(args), fg='blue')
+    with output_lock:
+        click.secho(_join(args), fg='blue')
 
 
 def error(*args, **kwargs):
-    click.secho(u' '.join(args), fg='red')
+    with output_lock:
+        click.secho(_join(args), fg='red')
     exitcode = kwargs.get('exitcode', 1)
     if exitcode is not None:
         sys.exit(exitcode)
 
 
-@click.group(context_settings={
+class Group(click.Group):
+    def parse_args(self, ctx, args):
+        # click empties ctx.protected_args and ctx.args before running the
+        # group callback: keep the arguments of the subcommand for it
+        args = super(Group, self).parse_args(ctx, args)
+        ctx.meta['subcommand_args'] = list(args)
+        return args
+
+
+def help_requested(ctx):
+    """Says if the help of the subcommand is asked, the arguments after -- excluded"""
+    args = ctx.meta.get('subcommand_args', [])
+    # native strings: on Python 2 the arguments may be non-ASCII bytes
+    if str('--') in args:
+        args = args[:args.index(str('--'))]
+    help_names = [str(name) for name in ctx.help_option_names]
+    return any(arg in help_names for arg in args)
+
+
+CONTEXT_SETTINGS = {
     'allow_extra_args': True,
     'ignore_unknown_options': True,
-    'help_option_names':['-h','--help'],
-})
+    'help_option_names': ('-h', '--help'),
+}
+
+jobs_option = click.option('--jobs', '-j', default=1, type=click.IntRange(1, None),
+                           help='Number of externals to process in parallel (default: 1)')
+
+
+@click.group(cls=Group, context_settings=CONTEXT_SETTINGS)
 @click.version_option(__version__)
 @click.option('--with-color/--no-color',
               default=True,
@@ -54,6 +95,10 @@ def cli(ctx, with_color):
     """
     from git_externals import is_git_repo, externals_json_path, externals_root_path
 
+    # the subcommand is only going to print its help, which needs no repository
+    if help_requested(ctx):
+        return
+
     if not is_git_repo():
         error("{} is not a git repository!".format(os.getcwd()), exitcode=2)
 
@@ -64,7 +109,8 @@ def cli(ctx, with_color):
         if ctx.invoked_subcommand not in set(['update', 'add']):
             error('You must first run git-externals update/add', exitcode=2)
     else:
-        if with_color:
+        # click strips colors anyway when not writing to a terminal
+        if with_color and sys.stdout.isatty() and 'NO_COLOR' not in os.environ:
             enable_colored_output()
 
         if ctx.invoked_subcommand is None:
@@ -73,35 +119,59 @@ def cli(ctx, with_color):
 
 @cli.command('foreach')
 @click.option('--recursive/--no-recursive', help='If --recursive is specified, this command will recurse into nested externals', default=True)
+@jobs_option
 @click.argument('subcommand', nargs=-1, required=True)
-def gitext_foreach(recursive, subcommand):
+def gitext_foreach(recursive, jobs, subcommand):
     """Evaluates an arbitrary shell command in each checked out external
     """
     from git_externals import externals_sanity_check, get_repo_name, foreach_externals_dir, root_path
 
     externals_sanity_check()
 
+    # the same header comes before the output of the command in both modes,
+    # only failures are reported after it
+    def header(rel_url, ext_path):
+        info("External {}".format(get_repo_name(rel_url)))
+        info("CWD: {}, cmd: {}".format(ext_path, subcommand))
+
+    def failure(err, ext_path):
+        info("Command error {} CWD: {}, cmd: {}".format(err, ext_path, subcommand))
+        error(str(err), exitcode=err.errcode)
+
+    def stream_command(rel_url, ext_path, targets):
+        header(rel_url, ext_path)
+        try:
+            for line in command_streaming(*subcommand, cwd=ext_path):
+                click.echo(line, nl=False)
+        except CommandError as err:
+            failure(err, ext_path)
+
     def run_command(rel_url, ext_path, targets):
+        # output of parallel commands is buffered, not to mix their lines
         try:
-            info("External {}".format(get_repo_name(rel_url)))
-            output = decode_utf8(command(*subcommand))
-            info("Ok: CWD: {}, cmd: {}".format(os.getcwd(), subcommand))
-            echo(output)
+            output = decode_utf8(command(*subcommand, cwd=ext_path))
+            with output_lock:
+                header(rel_url, ext_path)
+                click.echo(output, nl=False)
         except CommandError as err:
-            info("Command error {} CWD: {}, cmd: {}".format(err, os.getcwd(), subcommand))
-            error(str(err), exitcode=err.errcode)
+            with output_lock:
+                header(rel_url, ext_path)
+                failure(err, ext_path)
 
-    foreach_externals_dir(root_path(), run_command, recursive=recursive)
+    foreach_externals_dir(root_path(), run_command if jobs > 1 else stream_command,
+                          recursive=recursive, jobs=jobs)
 
 
 @cli.command('update')
 @click.option('--recursive/--no-recursive', help='Do not call git-externals update recursively', default=True)
 @click.option('--gitsvn/--no-gitsvn', help='use git-svn (or simply svn) to checkout SVN repositories (only needed at first checkout)', default=True)
 @click.option('--reset', help='Reset repo, overwrite local modifications', is_flag=True)
-def gitext_update(recursive, gitsvn, reset):
+@jobs_option
+def gitext_update(recursive, gitsvn, reset, jobs):
     """Update the working copy cloning externals if needed and create the desired layout using symlinks
     """
-    from git_externals import externals_sanity_check, root_path, is_workingtree_clean, foreach_externals, gitext_up
+    from git_externals import externals_sanity_check, root_path, is_workingtree_clean, foreach_externals, \
+                              gitext_up, StopWalk
 
     externals_sanity_check()
     root = root_path()
@@ -109,16 +179,23 @@ def gitext_update(recursive, gitsvn, reset):
     if reset:
         git('reset', '--hard')
 
-    # Aggregate in a list the `clean flags` of all working trees (root + externals)
-    clean = [is_workingtree_clean(root, fail_on_empty=False)]
-    foreach_externals(root,
-        lambda u, p, r: clean.append(is_workingtree_clean(p, fail_on_empty=False)),
-        recursive=recursive)
-
-    if reset or all(clean):
+    def all_clean():
+        # Check the working trees (root + externals) until a dirty one is found
+        if not is_workingtree_clean(root, fail_on_empty=False):
+            return False
+        dirty = []
+        def check(rel_url, ext_path, refs):
+            if not is_workingtree_clean(ext_path, fail_on_empty=False):
+                dirty.append(ext_path)
+                raise StopWalk()
+        foreach_externals(root, check, recursive=recursive)
+        return not dirty
+
+    # local modifications are discarded anyway on reset, no need to look for them
+    if reset or all_clean():
         # Proceed with update if everything is clean
         try:
-            gitext_up(recursive, reset=reset, use_gitsvn=gitsvn)
+            gitext_up(recursive, reset=reset, use_gitsvn=gitsvn, jobs=jobs)
         except ProgError as e:
             error(str(e), exitcode=e.errcode)
     else:
@@ -135,33 +212,70 @@ def gitext_update(recursive, gitsvn, reset):
     '--verbose/--no-verbose',
     is_flag=True,
     help='Show the full output of git status, instead of showing only the modifications regarding tracked file')
+@jobs_option
 @click.argument('externals', nargs=-1)
-def gitext_st(porcelain, verbose, externals):
+def gitext_st(porcelain, verbose, jobs, externals):
     """Call git status on the given externals"""
-    from git_externals import foreach_externals_dir, root_path, \
+    from git_externals import foreach_externals, foreach_externals_dir, root_path, \
                               is_workingtree_clean, get_repo_name
 
+    if porcelain:
+        # up to `jobs` externals at a time, reported in walk order
+        found = []
+        foreach_externals(root_path(), lambda u, p, r: found.append((u, p)),
+                          recursive=True, only=externals)
+        found = [(u, p) for u, p in found if os.path.exists(p)]
+        try:
+            statuses = parallel_map(lambda args: git('status', '--porcelain', cwd=args[1]),
+                                    found, jobs=jobs)
+        except ProgError as err:
+            error(str(err), exitcode=err.errcode)
+        for (rel_url, _), status in zip(found, statuses):
+            echo(rel_url)
+            click.echo(status)
+        return
+
     def get_status(rel_url, ext_path, targets):
         try:
-            if porcelain:
-                echo(rel_url)
-                click.echo(git('status', '--porcelain'))
-            elif verbose or not is_workingtree_clean(ext_path):
-                info("External {}".format(get_repo_name(rel_url)))
-                echo(git('status', '--untracked-files=no' if not verbose else ''))
+            if verbose or not is_workingtree_clean(ext_path):
+                args = ('status',) if verbose else ('status', '--untracked-files=no')
+                if jobs == 1:
+                    info("External {}".format(get_repo_name(rel_url)))
+                    git('--no-pager', *args, cwd=ext_path, capture=False)
+                    return
+                status = git(*args, cwd=ext_path)
+                with output_lock:
+                    info("External {}".format(get_repo_name(rel_url)))
+                    echo(status)
         except CommandError as err:
             error(str(err), exitcode=err.errcode)
 
-    foreach_externals_dir(root_path(), get_status, recursive=True, only=externals)
+    foreach_externals_dir(root_path(), get_status, recursive=True, only=externals, jobs=jobs)
 
 
 @cli.command('diff')
+@jobs_option
 @click.argument('external', nargs=-1)
-def gitext_diff(external):
+def gitext_diff(jobs, external):
     """Call git diff on the given externals"""
-    from git_externals import iter_externals
-    for _ in iter_externals(external):
-        click.echo(git('diff'))
+    from git_externals import iter_externals, externals_root_path
+
+    root = externals_root_path()
+
+    def get_diff(entry):
+        if jobs == 1:
+            # let git write straight to the terminal, nothing to keep apart
+            info('External {}'.format(entry))
+            git('--no-pager', 'diff', cwd=os.path.join(root, entry), capture=False)
+            return
+        diff = git('diff', cwd=os.path.join(root, entry))
+        with output_lock:
+            info('External {}'.format(entry))
+            # like git with an empty diff, print nothing below the header
+            if diff:
+                click.echo(diff)
+
+    parallel_map(get_diff, iter_externals(external, verbose=False), jobs=jobs)
 
 
 @cli.command('add')
@@ -194,52 +308,56 @@ def gitext_add(external, src, dst, branch, tag, ref, vcs):
         error('Please specifiy at least a branch or a tag', exitcode=3)
 
     if external not in git_externals:
-        git_externals[external] = {'targets': {src: [dst]}}
+        ext = {'targets': {src: [dst]}}
         if branch is not None:
-            git_externals[external]['branch'] = branch
-            git_externals[external]['ref'] = ref
+            ext['branch'] = branch
+            ext['ref'] = ref
         else:
-            git_externals[external]['tag'] = tag
+            ext['tag'] = tag
         if vcs == 'auto':
-            git_externals.update(normalize_gitexts({external: git_externals[external]}))
+            normalize_gitexts({external: ext})
         else:
-            git_externals[external]['vcs'] = vcs
+            ext['vcs'] = vcs
+        git_externals[external] = ext
 
     else:
+        ext = git_externals[external]
         if branch is not None:
-            if 'branch' not in git_externals[external]:
+            if 'branch' not in ext:
                 error(
                     '{} is bound to tag {}, cannot set it to branch {}'.format(
-                        external, git_externals[external]['tag'], branch),
+                        external, ext['tag'], branch),
                     exitcode=4)
 
-            if ref != git_externals[external]['ref']:
+            if ref != ext['ref']:
                 error('{} is bound to ref {}, cannot set it to ref {}'.format(
-                    external, git_externals[external]['ref'], ref),
+                    external, ext['ref'], ref),
                     exitcode=4)
 
-        elif 'tag' not in git_externals[external]:
+        elif 'tag' not in ext:
             error('{} is bound to branch {}, cannot set it to tag {}'.format(
-                external, git_externals[external]['branch'], tag),
+                external, ext['branch'], tag),
                 exitcode=4)
 
-        if dst not in git_externals[external]['targets'].setdefault(src, []):
-            git_externals[external]['targets'][src].append(dst)
+        dsts = ext['targets'].setdefault(src, [])
+        if dst not in dsts:
+            dsts.append(dst)
 
-    print_gitext_info(external, git_externals[external], root_dir='.')
+    print_gitext_info(external, ext, root_dir='.')
     dump_gitexts(git_externals)
 
 
 @cli.command('freeze')
 @click.option('--messages', '-m', is_flag=True, help="List commit messages")
+@jobs_option
 @click.argument('externals', nargs=-1, metavar='NAME')
-def gitext_freeze(externals, messages):
+def gitext_freeze(externals, messages, jobs):
     """Freeze the externals revision"""
     from git_externals import load_gitexts, dump_gitexts, foreach_externals_dir, root_path, resolve_revision
     git_externals = load_gitexts()
     repo_root = root_path()
-    re_from_git_svn_id = re.compile("git-svn-id:.*@(\d+)")
-    re_from_svnversion = re.compile("(\d+):(\d+)")
+    # protects git_externals, updated by the threads when jobs > 1
+    lock = threading.Lock()
 
     def get_version(rel_url, ext_path, refs):
         if 'tag' in refs:
@@ -247,32 +365,42 @@ def gitext_freeze(externals, messages):
 
         bare_svn = False
         if git_externals[rel_url]["vcs"] == "svn":
-            revision = command('svnversion', '-c').strip()
-            match = re_from_svnversion.search(revision)
+            # git-svn clones have no use for svnversion, go straight to git log
+            if os.path.exists(os.path.join(ext_path, '.git')):
+                match = None
+            else:
+                revision = command('svnversion', '-c', cwd=ext_path).strip()
+                match = RE_FROM_SVNVERSION.search(revision)
             if match:
                 revision = "svn:r" + match.group(2)  # 565:56555 -> svn:r56555
                 bare_svn = True
             else:
-                message = git("log", "--format=%b", "--grep", "git-svn-id:", "-1")
-                match = re_from_git_svn_id.search(message)
+                message = git("log", "--format=%b", "--grep", "git-svn-id:", "-1", cwd=ext_path)
+                match = RE_FROM_GIT_SVN_ID.search(message)
                 if match:
                     revision = "svn:r" + match.group(1)
                 else:
-                    here = os.path.relpath(os.getcwd(), repo_root)
+                    here = os.path.relpath(ext_path, repo_root)
                     error("Unsupported external format, svn or git-svn repo expected:\n\t{}".format(here))
         else:
-            branch_name = current_branch()
-            remote_name = git("config", "branch.%s.remote" % branch_name)
-            revision = git("log", "%s/%s" % (remote_name, branch_name), "-1", "--format=%H")
+            branch_name = current_branch(cwd=ext_path)
+            remote_name = git("config", "branch.%s.remote" % branch_name, cwd=ext_path).strip()
+            revision = git("log", "%s/%s" % (remote_name, branch_name), "-1", "--format=%H",
+                           cwd=ext_path).strip()
 
-        info("Freeze {0} at {1}".format(rel_url, revision))
+        log = None
         if messages and not bare_svn:
-            old = resolve_revision(git_externals[rel_url]["ref"])
-            new = resolve_revision(revision)
-            git("log", "--format=- %h %s", "{}..{}".format(old, new), capture=False)
-        git_externals[rel_url]["ref"] = revision
-
-    foreach_externals_dir(repo_root, get_version, only=externals)
+            old = resolve_revision(git_externals[rel_url]["ref"], cwd=ext_path)
+            new = resolve_revision(revision, cwd=ext_path)
+            log = git("log", "--format=- %h %s", "{}..{}".format(old, new), cwd=ext_path)
+        with output_lock:
+            info("Freeze {0} at {1}".format(rel_url, revision))
+            if log is not None:
+                click.echo(log, nl=False)
+        with lock:
+            git_externals[rel_url]["ref"] = revision
+
+    foreach_externals_dir(repo_root, get_version, only=externals, jobs=jobs)
 
     dump_gitexts(git_externals)
 
@@ -299,15 +427,28 @@ def gitext_remove(external):
 def gitext_info(externals, recursive):
     """Print some info about the externals."""
     from git_externals import gitext_recursive_info
-    gitext_recursive_info('.', recursive=recursive, externals=externals)
+    gitext_recursive_info('.', recursive=recursive, externals=frozenset(externals))
 
 
 def enable_colored_output():
     from git_externals import externals_root_path, get_entries
 
+    # since git 2.31 colors can be forced in the git processes started from
+    # now on through the environment, instead of running `git config` in each
+    # external, on top of any configuration already passed this way
+    if git_version() >= (2, 31):
+        try:
+            count = int(os.environ.get('GIT_CONFIG_COUNT', 0))
+        except ValueError:
+            return
+        os.environ[str('GIT_CONFIG_KEY_%d' % count)] = str('color.ui')
+        os.environ[str('GIT_CONFIG_VALUE_%d' % count)] = str('always')
+        os.environ[str('GIT_CONFIG_COUNT')] = str(count + 1)
+        return
+
+    root = externals_root_path()
     for entry in get_entries():
-        with chdir(os.path.join(externals_root_path(), entry)):
-            git('config', 'color.ui', 'always')
+        git('config', 'color.ui', 'always', cwd=os.path.join(root, entry))
 
 
 def main():
@@ -7,10 +7,13 @@ if __package__ is None:
     from os import path
     sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
+import io
 import json
 import os
 import os.path
 import posixpath
+import threading
+from bisect import bisect_left
 from collections import defaultdict, namedtuple
 
 try:
@@ -20,15 +23,16 @@ except ImportError:
 
 import click
 
-from .utils import (chdir, mkdir_p, link, rm_link, git, GitError, svn, gitsvn, gitsvnrebase, current_branch)
-from .cli import echo, info, error
+from .utils import (chdir, mkdir_p, link, rm_link, git, GitError, svn, gitsvn, gitsvnrebase, current_branch,
+                    parallel_map, GitBatch, atomic_write)
+from .cli import echo, info, error, output_lock
 
 
 OLD_EXTERNALS_ROOT = os.path.join('.git', 'externals')
 EXTERNALS_ROOT = '.git_externals'
 EXTERNALS_JSON = 'git_externals.json'
 
-ExtItem = namedtuple('ExtItem', ['branch', 'ref', 'path', 'name'])
+ExtItem = namedtuple('ExtItem', ['branch', 'ref', 'tag', 'path', 'name'])
 
 
 def get_repo_name(repo):
@@ -38,13 +42,27 @@ def get_repo_name(repo):
         #                                              externals[repo]['name']))
         return externals[repo]['name']
 
-    if repo[-1] == '/':
-        repo = repo[:-1]
-    name = repo.split('/')[-1]
+    name = repo_basename(repo)
+    if not name:
+        error("Invalid repository name: \"{}\"".format(repo.rstrip('/')), exitcode=1)
+    return name
+
+
+# repository url -> default name of its external
+_repo_basenames = {}
+
+
+def repo_basename(repo):
+    """Last component of the repository url, without .git"""
+    try:
+        return _repo_basenames[repo]
+    except KeyError:
+        pass
+    name = repo[:-1] if repo[-1] == '/' else repo
+    name = name.rsplit('/', 1)[-1]
     if name.endswith('.git'):
         name = name[:-len('.git')]
-    if not name:
-        error("Invalid repository name: \"{}\"".format(repo), exitcode=1)
+    _repo_basenames[repo] = name
     return name
 
 
@@ -52,41 +70,79 @@ def externals_json_path(pwd=None):
     return os.path.join(pwd or root_path(), EXTERNALS_JSON)
 
 
+# repository root -> its externals root, once checked for the old location
+_externals_roots = {}
+
+
 def externals_root_path(pwd=None):
-    _old_root_path = os.path.join(pwd or root_path(), OLD_EXTERNALS_ROOT)
-    _root_path = os.path.join(pwd or root_path(), EXTERNALS_ROOT)
+    base = pwd or root_path()
+    try:
+        return _externals_roots[base]
+    except KeyError:
+        pass
+    _old_root_path = os.path.join(base, OLD_EXTERNALS_ROOT)
+    _root_path = os.path.join(base, EXTERNALS_ROOT)
     if os.path.exists(_old_root_path) and not os.path.exists(_root_path):
         info("Moving old externals path to new location")
         os.rename(_old_root_path, _root_path)
         link_entries(load_gitexts(pwd))
     elif os.path.exists(_old_root_path) and os.path.exists(_root_path):
         error("Both new and old externals folder found, {} will be used".format(_root_path))
+    _externals_roots[base] = _root_path
     return _root_path
 
 
+# working directory -> answer of git rev-parse, the process chdir()s around
+_root_paths = {}
+_git_repos = {}
+
+
 def root_path():
-    return git('rev-parse', '--show-toplevel').strip()
+    cwd = os.getcwd()
+    try:
+        return _root_paths[cwd]
+    except KeyError:
+        path = _root_paths[cwd] = git('rev-parse', '--show-toplevel').strip()
+        return path
 
 
 def is_git_repo(quiet=True):
     """Says if pwd is a Git working tree or not.
     If not quiet: says it also on standard output
     """
+    cwd = os.getcwd()
+    if cwd in _git_repos:
+        return _git_repos[cwd]
     try:
-        return git('rev-parse', '--is-inside-work-tree').strip() == 'true'
+        res = _git_repos[cwd] = git('rev-parse', '--is-inside-work-tree').strip() == 'true'
+        return res
     except GitError as err:
         if not quiet:
             print (str(err))
 
 
+# working directory -> url of the remote its current branch tracks
+_remote_urls = {}
+
+
+def current_remote_url():
+    cwd = os.getcwd()
+    try:
+        return _remote_urls[cwd]
+    except KeyError:
+        pass
+    remote_name = git('config', 'branch.%s.remote' % current_branch()).strip()
+    url = _remote_urls[cwd] = git('config', 'remote.%s.url' % remote_name).strip()
+    return url
+
+
 def normalize_gitext_url(url):
     # an absolute url is already normalized
     if urlparse(url).netloc != '' or url.startswith('git@'):
         return url
 
     # relative urls use the root url of the current origin
-    remote_name = git('config', 'branch.%s.remote' % current_branch()).strip()
-    remote_url = git('config', 'remote.%s.url' % remote_name).strip()
+    remote_url = current_remote_url()
 
     if remote_url.startswith('git@'):
         prefix = remote_url[:remote_url.index(':')+1]
@@ -98,21 +154,41 @@ def normalize_gitext_url(url):
 
 
 def get_entries():
-    return [get_repo_name(e)
-            for e in load_gitexts().keys()
-            if os.path.exists(os.path.join(externals_root_path(), get_repo_name(e)))]
+    # one directory listing instead of a stat for each external
+    try:
+        present = set(os.listdir(externals_root_path()))
+    except OSError:
+        return []
+    names = (get_repo_name(e) for e in load_gitexts().keys())
+    return [name for name in names if name in present]
+
+
+# absolute path of a definition file -> ((mtime, size), parsed content)
+_gitexts_cache = {}
 
 
 def load_gitexts(pwd=None):
     """Load the *externals definition file* present in given
-    directory, or cwd
+    directory, or cwd.
+    Files are parsed again only when they change on disk, so the returned
+    dictionary is shared between callers: do not modify it unless it is then
+    saved with dump_gitexts.
     """
     d = pwd if pwd is not None else '.'
-    fn = os.path.join(d, EXTERNALS_JSON)
-    if os.path.exists(fn):
-        with open(fn) as f:
-            return normalize_gitexts(json.load(f))
-    return {}
+    fn = os.path.abspath(os.path.join(d, EXTERNALS_JSON))
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return {}
+    # nanoseconds where available (Python 3), float rounding can hide changes
+    key = (getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size)
+    cached = _gitexts_cache.get(fn)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    with io.open(fn, encoding='utf-8') as f:
+        gitexts = normalize_gitexts(json.load(f))
+    _gitexts_cache[fn] = (key, gitexts)
+    return gitexts
 
 
 def normalize_gitexts(gitext):
@@ -127,9 +203,17 @@ def dump_gitexts(externals):
     Dump externals dictionary as json in current working directory
     git_externals.json. Remove 'vcs' key that is only used at runtime.
     """
-    with open(externals_json_path(), 'w') as f:
-        json.dump(externals, f, sort_keys=True, indent=4, separators=(',', ': '))
-        f.write("\n")
+    fn = externals_json_path()
+    # serialized first, to write the file at once instead of piece by piece;
+    # non ASCII characters are kept as they are rather than escaped
+    data = json.dumps(externals, sort_keys=True, indent=4, separators=(',', ': '),
+                      ensure_ascii=False)
+    atomic_write(fn, data + "\n")
+    _gitexts_cache.pop(os.path.abspath(fn), None)
+
+
+class StopWalk(Exception):
+    """Raised by a foreach_externals callback to skip the remaining externals"""
 
 
 def foreach_externals(pwd, callback, recursive=True, only=()):
@@ -141,50 +225,86 @@ def foreach_externals(pwd, callback, recursive=True, only=()):
         - refs: external as a dictionary (straight from json file)
     Iterates over all externals by default, or filter over the externals listed
     in only (filters on externals path, url or part of it)
+    The iteration ends early if callback raises StopWalk.
     """
-    externals = load_gitexts(pwd)
-    def filter_ext():
-        def take_external(url, path):
-            return any((expr in url or expr in path) for expr in only)
-        def take_all(*args):
-            return True
-        return take_external if len(only) else take_all
-
-    for rel_url in externals:
-        ext_path = os.path.join(externals_root_path(pwd), get_repo_name(rel_url))
-        if filter_ext()(rel_url, ext_path):
-            callback(rel_url, ext_path, externals[rel_url])
+    # the filter is built once for the whole walk; expressions match substrings
+    # of urls and paths, so they are scanned in turn rather than looked up
+    only = tuple(only)
+    def take_external(url, path):
+        return any((expr in url or expr in path) for expr in only)
+    def take_all(*args):
+        return True
+
+    try:
+        _walk_externals(pwd, callback, recursive, take_external if only else take_all)
+    except StopWalk:
+        pass
+
+
+def _walk_externals(pwd, callback, recursive, take):
+    def children(path):
+        externals = load_gitexts(path)
+        if not externals:
+            return []
+        base = externals_root_path(path)
+        return [(rel_url, os.path.join(base, get_repo_name(rel_url)), ext)
+                for rel_url, ext in externals.items()]
+
+    # depth first with an explicit stack, visiting externals in the same order
+    # as recursion would: each one right before its own nested externals
+    stack = children(pwd)[::-1]
+    while stack:
+        rel_url, ext_path, ext = stack.pop()
+        if take(rel_url, ext_path):
+            callback(rel_url, ext_path, ext)
         if recursive:
-            foreach_externals(ext_path, callback, recursive=recursive, only=only)
+            stack.extend(children(ext_path)[::-1])
 
 
-def foreach_externals_dir(pwd, callback, recursive=True, only=[]):
+def foreach_externals_dir(pwd, callback, recursive=True, only=(), jobs=1):
     """
     Same as foreach_externals, but place the callback in the directory
-    context of the externals before calling it
+    context of the externals before calling it.
+    With jobs > 1 the callback is called for up to `jobs` externals at the
+    same time, from different threads: the working directory is shared, so
+    it is not changed and the callback must rely on its ext_path argument.
     """
+    if jobs > 1:
+        found = []
+        foreach_externals(pwd, lambda *args: found.append(args),
+                          recursive=recursive, only=only)
+        parallel_map(lambda args: callback(*args),
+                     [args for args in found if os.path.exists(args[1])],
+                     jobs=jobs)
+        return
+
     def run_from_dir(rel_url, ext_path, refs):
         if os.path.exists(ext_path):
             with chdir(ext_path):
                 callback(rel_url, ext_path, refs)
-    foreach_externals(root_path(), run_from_dir, recursive=recursive, only=only)
+    foreach_externals(pwd, run_from_dir, recursive=recursive, only=only)
 
 
-def sparse_checkout(repo_name, repo, dirs):
-    git('init', repo_name)
+def sparse_checkout(repo_name, repo, dirs, cwd=None):
+    # a single clone both fetches and sets up origin, leaving the work tree
+    # empty until the patterns below are in place
+    git('clone', '--no-checkout', '-c', 'core.sparsecheckout=true', repo, repo_name, cwd=cwd)
+    # the repository is created in cwd, if given, rather than in pwd
+    path = os.path.abspath(os.path.join(cwd or '.', repo_name))
 
-    with chdir(repo_name):
-        git('remote', 'add', '-f', 'origin', repo)
-        git('config', 'core.sparsecheckout', 'true')
+    # the definition file of the external, to find its own externals, with
+    # the directories (assumed to be terminated with /) used by the targets
+    patterns = ['/' + EXTERNALS_JSON]
+    patterns.extend(posixpath.normpath(d) + ('/' if d[-1] == '/' else '') for d in dirs)
+    atomic_write(os.path.join(path, '.git', 'info', 'sparse-checkout'), '\n'.join(patterns) + '\n')
 
-        with open(os.path.join('.git', 'info', 'sparse-checkout'), 'wt') as fp:
-            fp.write('{}\n'.format(externals_json_path()))
-            for d in dirs:
-                # assume directories are terminated with /
-                fp.write(posixpath.normpath(d))
-                if d[-1] == '/':
-                    fp.write('/')
-                fp.write('\n')
+    # populate the selected paths of the default branch, which the clone has
+    # already created; nothing to do for a repository without commits yet
+    try:
+        git('rev-parse', '--verify', '--quiet', 'HEAD', cwd=path)
+    except GitError:
+        return repo_name
+    git('read-tree', '-mu', 'HEAD', cwd=path)
 
     return repo_name
 
@@ -202,55 +322,93 @@ def is_workingtree_clean(path, fail_on_empty=True):
         return not fail_on_empty
     if fail_on_empty and not os.path.exists(path):
         return False
-    with chdir(path):
-        try:
-            return len([line.strip for line in git('status', '--untracked-files=no', '--porcelain').splitlines(True)]) == 0
-        except GitError as err:
-            echo('Couldn\'t retrieve Git status of', path)
-            error(str(err), exitcode=err.errcode)
+    try:
+        return not git('status', '--untracked-files=no', '--porcelain', '-z', cwd=path)
+    except GitError as err:
+        echo('Couldn\'t retrieve Git status of', path)
+        error(str(err), exitcode=err.errcode)
+
+
+def _link_target(path):
+    try:
+        return os.readlink(path)
+    except (AttributeError, NotImplementedError, OSError):
+        # not a symlink, or no symlinks on this platform
+        return None
 
 
 def link_entries(git_externals):
-    entries = [(get_repo_name(repo), src, os.path.join(os.getcwd(), dst.replace('/', os.path.sep)))
+    root = externals_root_path()
+    cwd = os.getcwd()
+    entries = [(os.path.normpath(os.path.join(root, get_repo_name(repo), src)),
+                os.path.join(cwd, dst.replace('/', os.path.sep)))
                for (repo, repo_data) in git_externals.items()
                for (src, dsts) in repo_data['targets'].items()
                for dst in dsts]
 
-    entries.sort(key=lambda x: x[2])
+    entries.sort(key=lambda x: x[1])
+
+    # links already pointing to their source are left alone, unless they are
+    # below a link that is going to be replaced: readlink() has looked them up
+    # through the old target of that one
+    relinked = ()
+    changed = []
+    for src, dst in entries:
+        if dst.startswith(relinked) or _link_target(dst) != src:
+            changed.append((src, dst))
+            relinked += (dst + os.path.sep,)
+    entries = changed
 
     # remove links starting from the deepest dst
-    for _, __, dst in entries[::-1]:
+    for _, dst in entries[::-1]:
         if os.path.lexists(dst):
             rm_link(dst)
 
-    # link starting from the highest dst
-    for repo_name, src, dst in entries:
-        with chdir(os.path.join(externals_root_path(), repo_name)):
-            mkdir_p(os.path.split(dst)[0])
-            link(os.path.abspath(src), dst)
+    # link starting from the highest dst, creating each parent directory once
+    parents = set()
+    for src, dst in entries:
+        parent = os.path.split(dst)[0]
+        if parent not in parents:
+            mkdir_p(parent)
+            parents.add(parent)
+        link(src, dst)
 
 
 def externals_sanity_check():
     """Check that we are not trying to track various refs of the same external repo"""
-    registry = defaultdict(set)
     root = root_path()
 
-    def registry_add(url, path, ext):
-        registry[url].add(ExtItem(ext['branch'], ext['ref'], path, ext.get('name', '')))
-
-    foreach_externals(root, registry_add, recursive=True)
-    errmsg = None
-    for url, set_ in registry.items():
-        # we are only interested to know if branch-ref pairs are duplicated
-        if len({(s[0], s[1]) for s in set_}) > 1:
-            if errmsg is None:
-                errmsg = ["Error: one project can not refer to different branches/refs of the same git external repository,",
-                          "however it appears to be the case for:"]
+    def item(path, ext):
+        # tag externals have neither branch nor ref
+        return ExtItem(ext.get('branch'), ext.get('ref'), ext.get('tag'), path, ext.get('name', ''))
+
+    # only the first checkout of each repository is kept and the others are
+    # compared to it, the complete list is gathered again for conflicts only
+    first = {}
+    conflicts = set()
+
+    def check(url, path, ext):
+        seen = first.setdefault(url, item(path, ext))
+        if seen[:3] != (ext.get('branch'), ext.get('ref'), ext.get('tag')):
+            conflicts.add(url)
+
+    foreach_externals(root, check, recursive=True)
+    if conflicts:
+        registry = defaultdict(list)
+
+        def registry_add(url, path, ext):
+            if url in conflicts:
+                registry[url].append(item(path, ext))
+
+        foreach_externals(root, registry_add, recursive=True)
+        errmsg = ["Error: one project can not refer to different branches/refs of the same git external repository,",
+                  "however it appears to be the case for:"]
+        for url, items in registry.items():
             errmsg.append('\t- {}, tracked as:'.format(url))
-            for i in set_:
-                errmsg.append("\t\t- external directory: '{0}'".format(os.path.relpath(i.path, root)))
-                errmsg.append("\t\t  branch: '{0}', ref: '{1}'".format(i.branch, i.ref))
-    if errmsg is not None:
+            errmsg.extend(line for i in items for line in (
+                "\t\t- external directory: '{0}'".format(os.path.relpath(i.path, root)),
+                "\t\t  tag: '{0}'".format(i.tag) if i.tag is not None else
+                "\t\t  branch: '{0}', ref: '{1}'".format(i.branch, i.ref)))
         errmsg.append("Please correct the corresponding {0} before proceeding".format(EXTERNALS_JSON))
         error('\n'.join(errmsg), exitcode=1)
     info('externals sanity check passed!')
@@ -259,26 +417,29 @@ def externals_sanity_check():
 
 
 def filter_externals_not_needed(all_externals, entries):
+    # all the prefixes are tried in a single startswith() call; a bisect on
+    # the sorted entries would miss a prefix when another entry sorts between
+    # it and the path (e.g. /a/b, /a/bc/d and /a/bz). Both sides end with a
+    # separator, so that /a/b matches itself and /a/b/c but not /a/bc
+    prefixes = tuple(e.rstrip(os.path.sep) + os.path.sep for e in entries)
     git_externals = {}
     for repo_name, repo_val in all_externals.items():
         filtered_targets = {}
         for src, dsts in repo_val['targets'].items():
-            filtered_dsts = []
-            for dst in dsts:
-                inside_external = any([os.path.abspath(dst).startswith(e) for e in entries])
-                if inside_external:
-                    filtered_dsts.append(dst)
+            filtered_dsts = [dst for dst in dsts
+                             if (os.path.abspath(dst) + os.path.sep).startswith(prefixes)]
 
             if filtered_dsts:
                 filtered_targets[src] = filtered_dsts
 
         if filtered_targets:
-            git_externals[repo_name] = all_externals[repo_name]
+            # copy, all_externals is shared through the load_gitexts cache
+            git_externals[repo_name] = dict(all_externals[repo_name])
             git_externals[repo_name]['targets'] = filtered_targets
 
     return git_externals
 
-def resolve_revision(ref, mode='git'):
+def resolve_revision(ref, mode='git', cwd=None):
     assert mode in ('git', 'svn'), "mode = {} not in (git, svn)".format(mode)
     if ref is not None:
         if ref.startswith('svn:r'):
@@ -287,90 +448,158 @@ def resolve_revision(ref, mode='git'):
             # If the revision starts with 'svn:r' in 'git' mode we search
             # for the matching hash.
             if mode == 'git':
-                ref = git('log', '--grep', 'git-svn-id:.*@%s' % ref, '--format=%H', capture=True).strip()
+                ref = git('log', '--grep', 'git-svn-id:.*@%s' % ref, '--format=%H', capture=True, cwd=cwd).strip()
     return ref
 
-def gitext_up(recursive, entries=None, reset=False, use_gitsvn=False):
+def gitext_up(recursive, entries=None, reset=False, use_gitsvn=False, jobs=1):
 
-    if not os.path.exists(externals_json_path()):
+    # nothing to do without a definition file, as in most nested externals:
+    # look for it in pwd, no need to ask git where the root is
+    all_externals = load_gitexts()
+    if not all_externals:
         return
 
-    all_externals = load_gitexts()
     git_externals = all_externals if entries is None else filter_externals_not_needed(all_externals, entries)
+    root = externals_root_path()
+    # with jobs > 1 the externals are updated by several threads at the same
+    # time: commands run in the external directories through cwd, and the
+    # messages and command output about each external are collected, to be
+    # printed in one block once it is done
+    capture = jobs > 1
+    collected = threading.local()
+
+    def report(func, *args):
+        lines = getattr(collected, 'lines', None)
+        if lines is None:
+            func(*args)
+        else:
+            lines.append((func, args))
 
-    def egit(command, *args):
+    def report_output(output):
+        if output:
+            report(echo, output.rstrip('\n'))
+
+    def egit(cwd, command, *args):
         if command == 'checkout' and reset:
             args = ('--force',) + args
-        git(command, *args, capture=False)
+        report_output(git(command, *args, capture=capture, merge_stderr=capture, cwd=cwd))
 
-    def git_initial_checkout(repo_name, repo_url):
+    def git_initial_checkout(ext, repo_name, repo_url):
         """Perform the initial git clone (or sparse checkout)"""
-        dirs = git_externals[ext_repo]['targets'].keys()
+        dirs = ext['targets'].keys()
         if './' not in dirs:
-            echo('Doing a sparse checkout of:', ', '.join(dirs))
-            sparse_checkout(repo_name, repo_url, dirs)
+            report(echo, 'Doing a sparse checkout of:', ', '.join(dirs))
+            sparse_checkout(repo_name, repo_url, dirs, cwd=root)
         else:
-            egit('clone', repo_url, repo_name)
+            egit(root, 'clone', repo_url, repo_name)
 
-    def git_update_checkout(reset):
+    def git_update_checkout(ext, path, reset):
         """Update an already existing git working tree"""
         if reset:
-            egit('reset', '--hard')
-            egit('clean', '-df')
-        egit('fetch', '--all')
-        egit('fetch', '--tags')
-        if 'tag' in git_externals[ext_repo]:
-            echo('Checking out tag', git_externals[ext_repo]['tag'])
-            egit('checkout', git_externals[ext_repo]['tag'])
-        else:
-            echo('Checking out branch', git_externals[ext_repo]['branch'])
-            egit('checkout', git_externals[ext_repo]['branch'])
-
-            rev = get_rev(ext_repo)
-            if rev is not None:
-                echo('Checking out commit', rev)
-                egit('checkout', rev)
+            egit(path, 'reset', '--hard')
+            egit(path, 'clean', '-df')
+        # one cat-file process answers the lookups of this external; it also
+        # sees the objects and refs fetched after it is started
+        with GitBatch(cwd=path) as batch:
+            # fetch only what is going to be checked out, not every ref of every remote
+            if 'tag' in ext:
+                egit(path, 'fetch', '--no-tags', 'origin', 'tag', ext['tag'])
+                commit = resolve_commit(batch, ext['tag'])
+                if commit is not None and read_head(path) == commit:
+                    report(echo, 'Already at tag', ext['tag'])
+                    return
+                report(echo, 'Checking out tag', ext['tag'])
+                egit(path, 'checkout', ext['tag'])
+            else:
+                egit(path, 'fetch', 'origin', ext['branch'])
+                ref = ext['ref']
+                if ref is None:
+                    # HEAD of fresh sparse checkouts names a branch yet to be created
+                    if (read_head(path) == 'ref: refs/heads/' + ext['branch'] and
+                            resolve_commit(batch, 'HEAD') is not None):
+                        report(echo, 'Already on branch', ext['branch'])
+                        return
+                # svn revisions are looked up in the history of the branch, once on it
+                elif not ref.startswith('svn:r'):
+                    commit = resolve_commit(batch, ref)
+                    if commit is None:
+                        # pinned outside of the branch history, look everywhere
+                        # (since git 1.9 --tags fetches tags in addition to the branches)
+                        egit(path, 'fetch', '--all', '--tags')
+                    elif read_head(path) == commit:
+                        report(echo, 'Already at commit', ref)
+                        return
+
+                report(echo, 'Checking out branch', ext['branch'])
+                egit(path, 'checkout', ext['branch'])
+
+                rev = resolve_revision(ref, cwd=path)
+                if rev is not None:
+                    report(echo, 'Checking out commit', rev)
+                    egit(path, 'checkout', rev)
+
+    def read_head(path):
+        """HEAD of the working tree: a commit if detached, else 'ref: <branch ref>'"""
+        try:
+            with open(os.path.join(path, '.git', 'HEAD')) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
 
-    def get_rev(ext_repo, mode='git'):
-        ref = git_externals[ext_repo]['ref']
-        return resolve_revision(ref, mode)
+    def resolve_commit(batch, rev):
+        return batch.resolve(rev + '^{commit}')
 
-    def gitsvn_initial_checkout(repo_name, repo_url):
+    def gitsvn_initial_checkout(ext, repo_name, repo_url):
         """Perform the initial git-svn clone (or sparse checkout)"""
-        min_rev = get_rev(ext_repo, mode='svn') or 'HEAD'
-        gitsvn('clone', normalized_ext_repo, repo_name, '-r%s' % min_rev, capture=False)
+        min_rev = resolve_revision(ext['ref'], mode='svn') or 'HEAD'
+        report_output(gitsvn('clone', repo_url, repo_name, '-r%s' % min_rev,
+                             capture=capture, merge_stderr=capture, cwd=root))
 
-    def gitsvn_update_checkout(reset):
+    def gitsvn_update_checkout(ext, path, reset):
         """Update an already existing git-svn working tree"""
         # FIXME: seems this might be necessary sometimes (happened with
         # 'vectorfonts' for example that the following error: "Unable to
         # determine upstream SVN information from HEAD history" was fixed by
         # adding that, but breaks sometimes. (investigate)
         # git('rebase', '--onto', 'git-svn', '--root', 'master')
-        gitsvnrebase('.', capture=False)
-        rev = get_rev(ext_repo) or 'git-svn'
-        echo('Checking out commit', rev)
-        git('checkout', rev)
+        report_output(gitsvnrebase('.', capture=capture, merge_stderr=capture, cwd=path))
+        rev = resolve_revision(ext['ref'], cwd=path) or 'git-svn'
+        report(echo, 'Checking out commit', rev)
+        git('checkout', rev, cwd=path)
 
-    def svn_initial_checkout(repo_name, repo_url):
+    def svn_initial_checkout(ext, repo_name, repo_url):
         """Perform the initial svn checkout"""
-        svn('checkout', '--ignore-externals', normalized_ext_repo, repo_name, capture=False)
+        svn('checkout', '--ignore-externals', repo_url, repo_name, cwd=root)
 
-    def svn_update_checkout(reset):
+    def svn_update_checkout(ext, path, reset):
         """Update an already existing svn working tree"""
         if reset:
-            svn('revert', '-R', '.')
-        rev = get_rev(ext_repo, mode='svn') or 'HEAD'
-        echo('Updating to commit', rev)
-        svn('up', '--ignore-externals', '-r%s' % rev, capture=False)
-
-    def autosvn_update_checkout(reset):
-        if os.path.exists('.git'):
-            gitsvn_update_checkout(reset)
+            svn('revert', '-R', '.', cwd=path)
+        rev = resolve_revision(ext['ref'], mode='svn') or 'HEAD'
+        report(echo, 'Updating to commit', rev)
+        svn('up', '--ignore-externals', '-r%s' % rev, cwd=path)
+
+    def autosvn_update_checkout(ext, path, reset):
+        if os.path.exists(os.path.join(path, '.git')):
+            gitsvn_update_checkout(ext, path, reset)
         else:
-            svn_update_checkout(reset)
+            svn_update_checkout(ext, path, reset)
 
-    for ext_repo in git_externals.keys():
+    def update(ext_repo):
+        if not capture:
+            update_external(ext_repo)
+            return
+        collected.lines = []
+        try:
+            update_external(ext_repo)
+        finally:
+            lines, collected.lines = collected.lines, None
+            with output_lock:
+                for func, args in lines:
+                    func(*args)
+
+    def update_external(ext_repo):
+        ext = git_externals[ext_repo]
         normalized_ext_repo = normalize_gitext_url(ext_repo)
 
         if all_externals[ext_repo]['vcs'] == 'git':
@@ -383,63 +612,92 @@ def gitext_up(recursive, entries=None, reset=False, use_gitsvn=False):
                 _initial_checkout = svn_initial_checkout
             _update_checkout = autosvn_update_checkout
 
-        mkdir_p(externals_root_path())
-        with chdir(externals_root_path()):
-            repo_name = get_repo_name(normalized_ext_repo)
-            ext_name = git_externals[ext_repo].get('name', '')
-            ext_name = ext_name if ext_name else repo_name
+        repo_name = get_repo_name(normalized_ext_repo)
+        ext_name = ext.get('name', '')
+        ext_name = ext_name if ext_name else repo_name
+        ext_path = os.path.join(root, ext_name)
 
-            info('External', ext_name)
-            if not os.path.exists(ext_name):
-                echo('Cloning external', ext_name)
-                _initial_checkout(ext_name, normalized_ext_repo)
+        report(info, 'External', ext_name)
+        if not os.path.exists(ext_path):
+            report(echo, 'Cloning external', ext_name)
+            _initial_checkout(ext, ext_name, normalized_ext_repo)
 
-            with chdir(ext_name):
-                echo('Retrieving changes from server: ', ext_name)
-                _update_checkout(reset)
+        report(echo, 'Retrieving changes from server: ', ext_name)
+        _update_checkout(ext, ext_path, reset)
+
+    mkdir_p(root)
+    parallel_map(update, git_externals.keys(), jobs=jobs)
 
     link_entries(git_externals)
 
     if recursive:
-        for ext_repo in git_externals.keys():
+        for ext_repo, ext in git_externals.items():
             entries = [os.path.realpath(d)
-                       for t in git_externals[ext_repo]['targets'].values()
+                       for t in ext['targets'].values()
                        for d in t]
-            with chdir(os.path.join(externals_root_path(), get_repo_name(ext_repo))):
-                gitext_up(recursive, entries, reset=reset, use_gitsvn=use_gitsvn)
+            with chdir(os.path.join(root, get_repo_name(ext_repo))):
+                gitext_up(recursive, entries, reset=reset, use_gitsvn=use_gitsvn, jobs=jobs)
 
 
-def gitext_recursive_info(root_dir, recursive=True, externals=[]):
-    git_exts = {ext_repo: ext for ext_repo, ext in load_gitexts().items()
-                if os.path.exists(os.path.join(externals_root_path(), get_repo_name(ext_repo)))}
+def gitext_recursive_info(root_dir, recursive=True, externals=(), realpaths=None):
+    all_exts = load_gitexts()
+    if not all_exts:
+        return
 
+    # the same destinations are resolved again at each nesting level, and
+    # nothing is linked while printing: remember the resolved paths
+    if realpaths is None:
+        realpaths = {}
+
+    def realpath(path):
+        path = os.path.abspath(path)
+        try:
+            return realpaths[path]
+        except KeyError:
+            real = realpaths[path] = os.path.realpath(path)
+            return real
+
+    root = externals_root_path()
+    try:
+        present = set(os.listdir(root))
+    except OSError:
+        present = set()
+    git_exts = {ext_repo: ext for ext_repo, ext in all_exts.items()
+                if get_repo_name(ext_repo) in present}
+
+    cwd = os.getcwd()
     for ext_repo, ext in git_exts.items():
-        entries = [os.path.realpath(d)
+        entries = [realpath(d)
                    for t in git_exts[ext_repo]['targets'].values()
                    for d in t]
 
-        cwd = os.getcwd()
         repo_name = get_repo_name(ext_repo)
         if externals and repo_name not in externals:
             continue
 
-        with chdir(os.path.join(externals_root_path(), repo_name)):
+        checkout = os.path.join(root, repo_name)
+        with chdir(checkout):
             filtered = filter_externals_not_needed(load_gitexts(), entries)
-            print_gitext_info(ext_repo, ext, root_dir, checkout=os.getcwd())
+            print_gitext_info(ext_repo, ext, root_dir, checkout=checkout)
 
             # if required, recurse into the externals repo of current external
             if recursive:
+                # paths below real_dst, if any, sort right from where it would
+                # be inserted; the trailing separator keeps out siblings that
+                # only share a prefix of the name (/a/b-c or /a/bc for /a/b)
+                deps = sorted(set(realpath(d) + os.path.sep
+                                  for e in filtered.values()
+                                  for ds in e['targets'].values()
+                                  for d in ds))
                 for dsts in ext['targets'].values():
                     for dst in dsts:
-                        real_dst = os.path.realpath(os.path.join(cwd, dst))
+                        real_dst = realpath(os.path.join(cwd, dst)) + os.path.sep
 
-                        has_deps = any([os.path.realpath(d).startswith(real_dst)
-                                        for e in filtered.values()
-                                        for ds in e['targets'].values()
-                                        for d in ds])
+                        idx = bisect_left(deps, real_dst)
+                        has_deps = idx < len(deps) and deps[idx].startswith(real_dst)
 
                         if has_deps:
-                            gitext_recursive_info(os.path.join(root_dir, dst))
+                            gitext_recursive_info(os.path.join(root_dir, dst), realpaths=realpaths)
 
 
 def print_gitext_info(ext_repo, ext, root_dir, checkout=False):
@@ -448,38 +706,46 @@ def print_gitext_info(ext_repo, ext, root_dir, checkout=False):
     `checkout` controls if printing the `Checkout` field (i.e real checkout
     directory) is required or not.
     """
-    click.secho('Repo:   {}'.format(ext_repo), fg='blue')
+    # collected and printed at once, click flushes stdout at each echo
+    lines = [click.style('Repo:   {}'.format(ext_repo), fg='blue')]
     if checkout:
-        click.echo('Checkout:    {}'.format(checkout))
+        lines.append('Checkout:    {}'.format(checkout))
 
     if 'tag' in ext:
-        click.echo('Tag:    {}'.format(ext['tag']))
+        lines.append('Tag:    {}'.format(ext['tag']))
     else:
-        click.echo('Branch: {}'.format(ext['branch']))
-        click.echo('Ref:    {}'.format(ext['ref']))
+        lines.append('Branch: {}'.format(ext['branch']))
+        lines.append('Ref:    {}'.format(ext['ref']))
 
     if 'name' in ext:
-        click.echo('Name:    {}'.format(ext['name']))
+        lines.append('Name:    {}'.format(ext['name']))
 
     for src, dsts in ext['targets'].items():
         for dst in dsts:
-            click.echo('  {} -> {}'.format(src, os.path.join(root_dir, dst)))
+            lines.append('  {} -> {}'.format(src, os.path.join(root_dir, dst)))
 
-    click.echo('')
+    lines.append('')
+    click.echo('\n'.join(lines))
 
 
 def iter_externals(externals, verbose=True):
     if not externals:
         externals = get_entries()
 
+    root = externals_root_path()
+    try:
+        present = set(os.listdir(root))
+    except OSError:
+        present = set()
+
     for entry in externals:
-        entry_path = os.path.join(externals_root_path(), entry)
+        entry_path = os.path.join(root, entry)
 
-        if not os.path.exists(entry_path):
+        # names given by the user may also be paths below the externals root
+        if entry not in present and not os.path.exists(entry_path):
             error('External {} not found'.format(entry), exitcode=None)
             continue
 
-        with chdir(entry_path):
-            if verbose:
-                info('External {}'.format(entry))
-            yield entry
+        if verbose:
+            info('External {}'.format(entry))
+        yield entry
@@ -95,7 +95,7 @@ __git_ext_status ()
   cur="${COMP_WORDS[COMP_CWORD]}"
 
   case "$cur" in
-    -*) opts="--porcelain --verbose --no-verbose" ;;
+    -*) opts="--porcelain --verbose --no-verbose --jobs" ;;
     *) __gitext_complete_externals "${cur}" ;;
   esac
 
@@ -116,7 +116,7 @@ __git_ext_diff ()
 __git_ext_update_foreach ()
 {
   local opts=""
-  opts="--recursive --no-recursive --gitsvn --no-gitsvn --reset"
+  opts="--recursive --no-recursive --gitsvn --no-gitsvn --reset --jobs"
   COMPREPLY=( ${COMPREPLY[@]:-} $(compgen -W "${opts}" -- "${cur}") )
 }
 
@@ -2,15 +2,23 @@
 
 from __future__ import print_function
 
+import io
 import subprocess
 import os
 import sys
 import logging
 import re
+import tempfile
+import threading
 
 from subprocess import check_call
 from contextlib import contextmanager
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
 
 class ProgError(Exception):
     def __init__(self, prog='', errcode=1, errmsg='', args=''):
@@ -48,7 +56,8 @@ class CommandError(ProgError):
 
 def svn(*args, **kwargs):
     universal_newlines = kwargs.get('universal_newlines', True)
-    output, err, errcode = _command('svn', *args, capture=True, universal_newlines=universal_newlines)
+    output, err, errcode = _command('svn', *args, capture=True, universal_newlines=universal_newlines,
+                                    cwd=kwargs.get('cwd'))
     if errcode != 0:
         print("running svn ", args)
         raise SvnError(errcode=errcode, errmsg=err)
@@ -57,58 +66,110 @@ def svn(*args, **kwargs):
 
 def git(*args, **kwargs):
     capture = kwargs.get('capture', True)
-    output, err, errcode = _command('git', *args, capture=capture, universal_newlines=True)
+    output, err, errcode = _command('git', *args, capture=capture, universal_newlines=True,
+                                    cwd=kwargs.get('cwd'), merge_stderr=kwargs.get('merge_stderr', False))
     if errcode != 0:
-        raise GitError(errcode=errcode, errmsg=err, args=args)
+        raise GitError(errcode=errcode, errmsg=output if err is None else err, args=args)
     return output
 
 
 def gitsvn(*args, **kwargs):
     capture = kwargs.get('capture', True)
-    output, err, errcode = _command('git', 'svn', *args, capture=capture, universal_newlines=True)
+    output, err, errcode = _command('git', 'svn', *args, capture=capture, universal_newlines=True,
+                                    cwd=kwargs.get('cwd'), merge_stderr=kwargs.get('merge_stderr', False))
     if errcode != 0:
-        raise GitSvnError(errcode=errcode, errmsg=err, args=args)
+        raise GitSvnError(errcode=errcode, errmsg=output if err is None else err, args=args)
     return output
 
 
 def gitsvnrebase(*args, **kwargs):
     capture = kwargs.get('capture', True)
-    output, err, errcode = _command('git-svn-rebase', *args, capture=capture, universal_newlines=True)
+    output, err, errcode = _command('git-svn-rebase', *args, capture=capture, universal_newlines=True,
+                                    cwd=kwargs.get('cwd'), merge_stderr=kwargs.get('merge_stderr', False))
     if errcode != 0:
-        raise GitSvnError(errcode=errcode, errmsg=err, args=args)
+        raise GitSvnError(errcode=errcode, errmsg=output if err is None else err, args=args)
     return output
 
 
 def command(cmd, *args, **kwargs):
     universal_newlines = kwargs.get('universal_newlines', True)
     capture = kwargs.get('capture', True)
-    output, err, errcode = _command(cmd, *args, universal_newlines=universal_newlines, capture=capture)
+    output, err, errcode = _command(cmd, *args, universal_newlines=universal_newlines, capture=capture,
+                                    cwd=kwargs.get('cwd'))
     if errcode != 0:
         raise CommandError(cmd, errcode=errcode, errmsg=err, args=args)
     return output
 
 
+def command_streaming(cmd, *args, **kwargs):
+    """
+    Same as command(), but yield the output line by line while `cmd` produces
+    it; its standard error is not captured and goes straight to the terminal
+    """
+    env = dict(os.environ)
+    env.setdefault('LC_MESSAGES', 'C')
+    p = subprocess.Popen([executable(cmd)] + list(args),
+                         stdout=subprocess.PIPE,
+                         universal_newlines=True,
+                         bufsize=1,
+                         env=env,
+                         cwd=kwargs.get('cwd'))
+    for line in iter(p.stdout.readline, ''):
+        yield decode_utf8(line)
+    p.stdout.close()
+    p.wait()
+    if p.returncode != 0:
+        raise CommandError(cmd, errcode=p.returncode, args=args)
+
+
+_executables = {}
+
+def executable(cmd):
+    """
+    Full path of the `cmd` program, looked up in PATH only the first time
+    """
+    try:
+        return _executables[cmd]
+    except KeyError:
+        path = _executables[cmd] = which(cmd) or cmd
+        return path
+
+
 def _command(cmd, *args, **kwargs):
     env = kwargs.get('env', dict(os.environ))
     env.setdefault('LC_MESSAGES', 'C')
     universal_newlines = kwargs.get('universal_newlines', True)
     capture = kwargs.get('capture', True)
+    # run from `cwd` if given, without changing the process working directory
+    cwd = kwargs.get('cwd')
     if capture:
         stdout, stderr = subprocess.PIPE, subprocess.PIPE
+        # keep progress and error reports in the output, in the order written
+        if kwargs.get('merge_stderr', False):
+            stderr = subprocess.STDOUT
     else:
         stdout, stderr = None, None
 
-    p = subprocess.Popen([cmd] + list(args),
+    p = subprocess.Popen([executable(cmd)] + list(args),
                          stdout=stdout,
                          stderr=stderr,
                          universal_newlines=universal_newlines,
-                         env=env)
+                         env=env,
+                         cwd=cwd)
     output, err = p.communicate()
     return output, err, p.returncode
 
 
-def current_branch():
-    return git('name-rev', '--name-only', 'HEAD').strip()
+GIT_VERSION_RE = re.compile(r'(\d+)\.(\d+)')
+
+def git_version():
+    """(major, minor) version of git, (0, 0) if it can not be told"""
+    m = GIT_VERSION_RE.search(git('--version'))
+    return (int(m.group(1)), int(m.group(2))) if m is not None else (0, 0)
+
+
+def current_branch(cwd=None):
+    return git('name-rev', '--name-only', 'HEAD', cwd=cwd).strip()
 
 
 def branches():
@@ -138,6 +199,40 @@ def git_remote_branches_and_tags():
     return _branches, _tags
 
 
+class GitBatch(object):
+    """
+    Long running `git cat-file --batch-check` process, used to resolve many
+    refs/revisions of the same repository without spawning a git process for
+    each query. Use it as a context manager so the process is reaped.
+    """
+
+    def __init__(self, cwd=None):
+        self.proc = subprocess.Popen([executable('git'), 'cat-file', '--batch-check'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     cwd=cwd)
+
+    def resolve(self, rev):
+        """Return the sha of the object `rev` points to, or None if missing"""
+        self.proc.stdin.write(u'{}\n'.format(rev).encode('utf8'))
+        self.proc.stdin.flush()
+        fields = decode_utf8(self.proc.stdout.readline()).split()
+        # "<sha> <type> <size>" on success, "<rev> missing" otherwise
+        if len(fields) != 3:
+            return None
+        return fields[0]
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 @contextmanager
 def checkout(branch, remote=None, back_to='master', force=False):
     brs = set(branches())
@@ -154,9 +249,52 @@ def checkout(branch, remote=None, back_to='master', force=False):
     check_call(cmd + [back_to])
 
 
+def parallel_map(func, items, jobs=1):
+    """
+    Call func on each of items using up to `jobs` threads and return the
+    results in order. No more items are handed out after the first failure,
+    which is re-raised in the calling thread (SystemExit included).
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    lock = threading.Lock()
+    pending = iter(enumerate(items))
+
+    def worker():
+        while True:
+            with lock:
+                if errors:
+                    return
+                try:
+                    idx, item = next(pending)
+                except StopIteration:
+                    return
+            try:
+                results[idx] = func(item)
+            except BaseException as err:
+                with lock:
+                    errors.append(err)
+                return
+
+    threads = [threading.Thread(target=worker) for _ in range(min(jobs, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
 @contextmanager
 def chdir(path):
-    cwd = os.path.abspath(os.getcwd())
+    cwd = os.getcwd()
 
     try:
         os.chdir(path)
@@ -170,6 +308,46 @@ def mkdir_p(path):
         os.makedirs(path)
 
 
+if hasattr(os, 'replace'):
+    _replace = os.replace
+else:
+    def _replace(src, dst):
+        # Python 2 rename cannot overwrite an existing file on Windows
+        if sys.platform.startswith('win32') and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def atomic_write(path, data):
+    """
+    Write data to path through a temporary file in the same directory, renamed
+    over path once complete: readers never see a truncated file.
+    The file is encoded as UTF-8.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    dirname, basename = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.{}.'.format(basename), dir=dirname or '.')
+    try:
+        # mkstemp creates the file readable by the owner only
+        try:
+            mode = os.stat(path).st_mode & 0o777
+        except OSError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp, mode)
+        with io.open(fd, 'w', encoding='utf-8') as f:
+            f.write(data)
+        _replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 def header(msg):
     banner = '=' * 78
 
@@ -0,0 +1,66 @@
+Commands working on several externals at a time:
+
+  $ export GIT_AUTHOR_NAME="Git Externals" GIT_AUTHOR_EMAIL="externals@test.com"
+  $ export GIT_COMMITTER_NAME="Git Externals" GIT_COMMITTER_EMAIL="externals@test.com"
+  $ ROOT=$(pwd)
+  $ repo() { git init -q --bare $1.git; git clone -q $1.git $1 2> /dev/null; }
+  $ for name in libA libB libC; do
+  >   repo $name
+  >   (cd $name && echo $name > $name.txt && git add $name.txt && git commit -q -m $name && git push -q origin HEAD:master)
+  > done
+
+  $ repo main
+  $ cd main
+  $ printf '.git_externals/\nlibA\nlibB\nlibC\n' > .gitignore
+  $ git add .gitignore
+  $ git commit -q -m "Ignore the externals"
+  $ git push -q origin HEAD:master
+  $ git branch -q --set-upstream-to=origin/master
+  $ for name in libA libB libC; do
+  >   git externals add -b master $ROOT/$name.git ./ $name > /dev/null
+  > done
+  $ git add git_externals.json
+  $ git commit -q -m "Add the externals"
+
+Update clones the externals in parallel, and reports about each one in a
+single block
+
+  $ git externals update -j 2 > update.log 2>&1
+  $ cat libA/libA.txt libB/libB.txt libC/libC.txt
+  libA
+  libB
+  libC
+  $ grep -c '^External' update.log
+  3
+  $ awk '/^External/ { name = $2 } /lib[ABC]/ && index($0, name) == 0' update.log
+
+Foreach prints the output of each external below its header
+
+  $ git externals foreach -j 2 -- git ls-files > foreach.log 2>&1
+  $ grep -v sanity foreach.log | sed -e "s|$ROOT/||" -e 's/, cmd: .*//' | paste - - - | sort
+  External libA\tCWD: main/.git_externals/libA\tlibA.txt (esc)
+  External libB\tCWD: main/.git_externals/libB\tlibB.txt (esc)
+  External libC\tCWD: main/.git_externals/libC\tlibC.txt (esc)
+
+A failing command is reported below the header of its external, and its
+exit code is returned
+
+  $ git externals foreach -j 2 -- test ! -f libB.txt > foreach.log 2>&1
+  [1]
+  $ grep -A2 '^External libB' foreach.log
+  External libB
+  CWD: */main/.git_externals/libB, cmd: * (glob)
+  Command error * (glob)
+
+Porcelain status lists the externals in the same order as without --jobs
+
+  $ echo changed >> libA/libA.txt
+  $ echo new > libC/new.txt
+  $ git externals status --porcelain > status.log
+  $ git externals status --porcelain -j 2 | diff status.log -
+  $ grep -A1 'libA.git$' status.log
+  */libA.git (glob)
+   M libA.txt
+  $ grep -A1 'libC.git$' status.log
+  */libC.git (glob)
+  ?? new.txt
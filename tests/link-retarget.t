@@ -0,0 +1,48 @@
+Links nested in a link whose target changes:
+
+  $ export GIT_AUTHOR_NAME="Git Externals" GIT_AUTHOR_EMAIL="externals@test.com"
+  $ export GIT_COMMITTER_NAME="Git Externals" GIT_COMMITTER_EMAIL="externals@test.com"
+  $ ROOT=$(pwd)
+  $ repo() { git init -q --bare $1.git; git clone -q $1.git $1 2> /dev/null; }
+  $ for name in libA libB libC; do
+  >   repo $name
+  >   (cd $name && echo $name > $name.txt && git add $name.txt && git commit -q -m $name && git push -q origin HEAD:master)
+  > done
+
+  $ repo main
+  $ cd main
+  $ echo m > m.txt
+  $ printf '.git_externals/\nlib\n' > .gitignore
+  $ git add m.txt .gitignore
+  $ git commit -q -m "Add m.txt"
+  $ git push -q origin HEAD:master
+  $ git branch -q --set-upstream-to=origin/master
+  $ git externals add -b master $ROOT/libA.git ./ lib > /dev/null
+  $ git externals add -b master $ROOT/libC.git ./ lib/sub > /dev/null
+  $ git add git_externals.json
+  $ git commit -q -m "Add libA and libC"
+  $ git externals update > /dev/null 2>&1
+  $ ls lib lib/sub
+  lib:
+  libA.txt
+  sub
+  
+  lib/sub:
+  libC.txt
+
+Point lib to libB instead: lib/sub is recreated in libB, and its link in
+libA goes away
+
+  $ git externals remove $ROOT/libA.git
+  $ git externals add -b master $ROOT/libB.git ./ lib > /dev/null
+  $ git commit -q -m "Replace libA with libB" git_externals.json
+  $ git externals update > /dev/null 2>&1
+  $ ls lib lib/sub
+  lib:
+  libB.txt
+  sub
+  
+  lib/sub:
+  libC.txt
+  $ ls .git_externals/libA
+  libA.txt
@@ -0,0 +1,56 @@
+Nested externals of a sparse checkout:
+
+  $ export GIT_AUTHOR_NAME="Git Externals" GIT_AUTHOR_EMAIL="externals@test.com"
+  $ export GIT_COMMITTER_NAME="Git Externals" GIT_COMMITTER_EMAIL="externals@test.com"
+  $ ROOT=$(pwd)
+  $ repo() { git init -q --bare $1.git; git clone -q $1.git $1 2> /dev/null; }
+
+An external with a file, and another one which tracks it in its own
+git_externals.json and is only partly used by the main repository
+
+  $ repo libC
+  $ cd libC
+  $ echo c > c.txt
+  $ git add c.txt
+  $ git commit -q -m "Add c.txt"
+  $ git push -q origin HEAD:master
+  $ cd ..
+
+  $ repo libB
+  $ cd libB
+  $ mkdir src doc
+  $ echo b > src/b.c
+  $ echo d > doc/README
+  $ git add src doc
+  $ git commit -q -m "Add sources"
+  $ git push -q origin HEAD:master
+  $ git branch -q --set-upstream-to=origin/master
+  $ git externals add -b master $ROOT/libC.git ./ src/libC > /dev/null
+  $ git add git_externals.json
+  $ git commit -q -m "Add libC"
+  $ git push -q origin HEAD:master
+  $ cd ..
+
+  $ repo main
+  $ cd main
+  $ echo m > m.txt
+  $ git add m.txt
+  $ git commit -q -m "Add m.txt"
+  $ git push -q origin HEAD:master
+  $ git branch -q --set-upstream-to=origin/master
+  $ git externals add -b master $ROOT/libB.git src/ libB-src > /dev/null
+  $ git add git_externals.json
+  $ git commit -q -m "Add libB"
+
+The definition file of libB is part of its sparse checkout, so libC is
+cloned too and linked inside the sources of libB
+
+  $ git externals update > /dev/null 2>&1
+  $ ls .git_externals/libB
+  git_externals.json
+  src
+  $ ls libB-src
+  b.c
+  libC
+  $ cat libB-src/libC/c.txt
+  c